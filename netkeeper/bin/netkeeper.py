@@ -9,46 +9,51 @@ Website: https://gitlab.salamek.cz/sadam/netkeeper.git
 Command details:
     run                 Run the application.
     status              Show status of router.
-Usage:
-    netkeeper run [-l DIR] [--config_prod]
-    netkeeper (-h | --help)
-    netkeeper status
-
-Options:
-    --config_prod               Load the production configuration instead of
-                                development.
-    -l DIR --log_dir=DIR        Log all statements to file in this directory
-                                instead of stdout.
-                                Only ERROR statements will go to stdout. stderr
-                                is not used.
 """
 
+from __future__ import annotations
+
+import argparse
 import logging
 import logging.handlers
+import atexit
+import queue
 import subprocess  # nosec B404
+import io
+import itertools
 import os
+import json
+import hashlib
 import time
 import sys
 import signal
 import shutil
-from functools import wraps
-from typing import Callable, TypeVar, Optional, List
-from importlib import import_module
-from yaml import load, FullLoader
-from docopt import docopt
-from huawei_lte_api.AuthorizedConnection import AuthorizedConnection
-from huawei_lte_api.Client import Client
-from huawei_lte_api.enums.cradle import ConnectionStatusEnum
-from huawei_lte_api.exceptions import ResponseErrorException
+import socket
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional, List, Dict, Deque, Mapping, Tuple, Type, Any, cast, TYPE_CHECKING
 import netkeeper as app_root
-from netkeeper.ext.multiping import multi_ping, MultiPingSocketError
-from netkeeper.config import Config
+from netkeeper.config import Config, Production
 
+# Heavy dependencies (yaml, huawei_lte_api and requests with it) are imported by the functions that use them,
+# so `netkeeper --help` and argument errors do not pay for importing them.
+# pylint: disable=import-outside-toplevel
+if TYPE_CHECKING:
+    from huawei_lte_api.AuthorizedConnection import AuthorizedConnection
+    from huawei_lte_api.Client import Client
+    from huawei_lte_api.enums.cradle import ConnectionStatusEnum
 
-CT = TypeVar('CT')
 
-OPTIONS = docopt(__doc__)
+STOP_EVENT = threading.Event()  # Set on exit, sleeping is done by waiting on it, so it can be interrupted
 APP_ROOT_FOLDER = os.path.abspath(os.path.dirname(app_root.__file__))
+CACHE_FOLDER = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'netkeeper')
+MIN_CHECK_INTERVAL = 5  # seconds
+RTT_REFERENCE_MS = 200
+SERVICE_ACTIVE_STATES = frozenset({'active', 'reloading'})
+SERVICE_ENABLED_STATES = frozenset({'enabled', 'enabled-runtime', 'alias', 'static', 'indirect', 'generated', 'transient'})
 
 
 class CustomFormatter(logging.Formatter):
@@ -59,7 +64,48 @@ class CustomFormatter(logging.Formatter):
         return super().format(record)
 
 
-def setup_logging(name: Optional[str] = None, level: int = logging.DEBUG) -> None:
+class BufferedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """TimedRotatingFileHandler that writes through a large buffer.
+
+    Rollover is checked at most once per CHECK_INTERVAL seconds instead of on every record.
+    Buffering only applies below WARNING: those records are flushed at most once per CHECK_INTERVAL seconds,
+    WARNING and above are flushed right away, so they are not lost on a crash and show up in `tail -f` immediately.
+    Production runs at WARNING level, so there only the rollover check is throttled, buffering pays off in DEBUG.
+    Anything still buffered is written when the handler is closed on exit.
+    """
+    CHECK_INTERVAL = 60  # seconds
+    BUFFER_SIZE = 65536
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        self._next_rollover_check = 0.0
+        self._next_flush = 0.0
+        super().__init__(*args, **kwargs)
+
+    def _open(self) -> io.TextIOWrapper:
+        stream = open(self.baseFilename, self.mode, buffering=self.BUFFER_SIZE,  # pylint: disable=consider-using-with
+                      encoding=self.encoding, errors=getattr(self, 'errors', None))
+        return cast(io.TextIOWrapper, stream)
+
+    def shouldRollover(self, record: logging.LogRecord) -> int:
+        now = time.monotonic()
+        if now < self._next_rollover_check:
+            return False
+        self._next_rollover_check = now + self.CHECK_INTERVAL
+        return super().shouldRollover(record)
+
+    def flush(self) -> None:
+        now = time.monotonic()
+        if now >= self._next_flush:
+            self._next_flush = now + self.CHECK_INTERVAL
+            super().flush()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        super().emit(record)
+        if record.levelno >= logging.WARNING:
+            super().flush()
+
+
+def setup_logging(name: Optional[str] = None, level: int = logging.DEBUG, log_dir: Optional[str] = None) -> None:
     """Setup Google-Style logging for the entire application.
 
     At first I hated this but I had to use it for work, and now I prefer it. Who knew?
@@ -69,16 +115,16 @@ def setup_logging(name: Optional[str] = None, level: int = logging.DEBUG) -> Non
 
     Positional arguments:
     name -- Append this string to the log file filename.
+    level -- Minimal level of logged statements.
+    log_dir -- Log all statements to file in this directory.
     """
-    log_to_disk = False
-    if OPTIONS['--log_dir']:
-        if not os.path.isdir(OPTIONS['--log_dir']):
-            print('ERROR: Directory {} does not exist.'.format(OPTIONS['--log_dir']))
+    if log_dir:
+        if not os.path.isdir(log_dir):
+            print('ERROR: Directory {} does not exist.'.format(log_dir))
             sys.exit(1)
-        if not os.access(OPTIONS['--log_dir'], os.W_OK):
-            print('ERROR: No permissions to write to directory {}.'.format(OPTIONS['--log_dir']))
+        if not os.access(log_dir, os.W_OK):
+            print('ERROR: No permissions to write to directory {}.'.format(log_dir))
             sys.exit(1)
-        log_to_disk = True
 
     fmt = '%(levelletter)s%(asctime)s.%(msecs).03d %(process)d %(filename)s:%(lineno)d] %(message)s'
     datefmt = '%m%d %H:%M:%S'
@@ -87,30 +133,111 @@ def setup_logging(name: Optional[str] = None, level: int = logging.DEBUG) -> Non
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(level)
     console_handler.setFormatter(formatter)
+    handlers: List[logging.Handler] = [console_handler]
+
+    if log_dir:
+        file_name = os.path.join(log_dir, 'token_api_{}.log'.format(name))
+        file_handler = BufferedTimedRotatingFileHandler(file_name, when='d', backupCount=7)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    # Logging calls only enqueue records, writing them out is done by the listener thread
+    log_queue: queue.Queue[logging.LogRecord] = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Runs before logging.shutdown, so queued records are handled before handlers close
 
     root = logging.getLogger()
     root.setLevel(level)
-    root.addHandler(console_handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def _write_private_file(file_name: str, content: str) -> None:
+    """Atomically replace file_name with content, readable by the owner only."""
+    tmp_file = '{}.tmp'.format(file_name)
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), mode=0o700, exist_ok=True)
+    with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='UTF-8') as f:
+        f.write(content)
+    os.replace(tmp_file, file_name)
+
+
+def _config_cache_files(path: str) -> List[str]:
+    """JSON cache file candidates for a YAML file, next to it or in CACHE_FOLDER when its directory is not writable."""
+    name_hash = hashlib.sha256(os.path.abspath(path).encode('UTF-8')).hexdigest()
+    return ['{}.cache.json'.format(path), os.path.join(CACHE_FOLDER, 'config.{}.cache.json'.format(name_hash))]
+
+
+def _read_config_cache(cache_file: str, key: str) -> Optional[dict]:
+    try:
+        with open(cache_file, encoding='UTF-8') as f:
+            if f.readline() != '# key={}\n'.format(key):
+                return None
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cached if isinstance(cached, dict) else None
+
+
+def _write_config_cache(cache_files: List[str], key: str, data: dict) -> None:
+    """Store parsed configuration as JSON into first cache file that can be written.
+
+    Configuration holds modem credentials, so the cache is readable by the owner only.
+    Data JSON can not represent as is (eg.: non-string keys, dates) is not cached, loading it back would change it.
+    Failing to write the cache is not an error, next start will just parse the YAML again.
+    """
+    try:
+        dumped = json.dumps(data)
+    except (TypeError, ValueError):
+        return
+    if json.loads(dumped) != data:
+        return
+    serialized = '# key={}\n{}'.format(key, dumped)
+    for cache_file in cache_files:
+        try:
+            _write_private_file(cache_file, serialized)
+            return
+        except OSError:
+            continue
 
-    if log_to_disk:
-        file_name = os.path.join(OPTIONS['--log_dir'], 'token_api_{}.log'.format(name))
-        file_handler = logging.handlers.TimedRotatingFileHandler(file_name, when='d', backupCount=7)
-        file_handler.setFormatter(formatter)
-        root.addHandler(file_handler)
 
+@lru_cache(maxsize=16)
+def _load_yaml(path: str, mtime: int, size: int) -> dict:
+    """Parse a single YAML configuration file.
 
-def get_config(config_class_string: str, yaml_files: Optional[List[str]] = None) -> Config:
+    Results are memoized on (path, mtime, size) in memory and in a JSON cache file, so a file is parsed again only
+    when it has changed on disk. The returned dict is shared between callers and must not be mutated.
+    """
+    key = hashlib.sha256('{}:{}:{}'.format(path, mtime, size).encode('UTF-8')).hexdigest()
+    cache_files = _config_cache_files(path)
+    for cache_file in cache_files:
+        cached = _read_config_cache(cache_file, key)
+        if cached is not None:
+            print('Loading config from {}'.format(cache_file))
+            return cached
+
+    from yaml import load
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:  # PyYAML built without libyaml
+        from yaml import SafeLoader as Loader  # type: ignore
+
+    print('Loading config from {}'.format(path))
+    with open(path, encoding='UTF-8') as f:
+        loaded_data = load(f, Loader=Loader)
+    if not isinstance(loaded_data, dict):
+        raise Exception('Failed to parse configuration {}'.format(path))
+    _write_config_cache(cache_files, key, loaded_data)
+    return loaded_data
+
+
+def get_config(config_obj: Type[Config], yaml_files: Optional[List[str]] = None) -> Type[Config]:
     """Load the Flask config from a class.
     Positional arguments:
-    config_class_string -- string representation of a configuration class that will be loaded (e.g.
-        'pypi_portal.config.Production').
+    config_obj -- configuration class that will be loaded (e.g. netkeeper.config.Production).
     yaml_files -- List of YAML files to load. This is for testing, leave None in dev/production.
     Returns:
     A class object to be fed into app.config.from_object().
     """
-    config_module, config_class = config_class_string.rsplit('.', 1)
-    config_obj = getattr(import_module(config_module), config_class)
-
     # Load additional configuration settings.
     yaml_files = yaml_files or [f for f in [
         os.path.join('/', 'etc', 'netkeeper', 'config.yml'),
@@ -123,13 +250,8 @@ def get_config(config_class_string: str, yaml_files: Optional[List[str]] = None)
 
     additional_dict = {}
     for y in yaml_files:
-        print('Loading config from {}'.format(y))
-        with open(y, encoding='UTF-8') as f:
-            loaded_data = load(f.read(), Loader=FullLoader)
-            if isinstance(loaded_data, dict):
-                additional_dict.update(loaded_data)
-            else:
-                raise Exception('Failed to parse configuration {}'.format(y))
+        stat = os.stat(y)
+        additional_dict.update(_load_yaml(y, stat.st_mtime_ns, stat.st_size))
 
     # Merge the rest into the Flask app config.
     for key, value in additional_dict.items():
@@ -138,157 +260,385 @@ def get_config(config_class_string: str, yaml_files: Optional[List[str]] = None)
     return config_obj
 
 
-def parse_options() -> Config:
+def parse_options(args: argparse.Namespace) -> Type[Config]:
     """Parses command line options for Flask.
 
+    Positional arguments:
+    args -- parsed command line arguments.
     Returns:
     Config instance to pass into create_app().
     """
-    # Figure out which class will be imported.
-    if OPTIONS['--config_prod']:
-        config_class_string = 'netkeeper.config.Production'
-    else:
-        config_class_string = 'netkeeper.config.Config'
-    config_obj = get_config(config_class_string)
+    return get_config(Production if args.config_prod else Config)
 
-    return config_obj
 
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='netkeeper', description='Netkeeper keeps your huawei router connected.')
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
 
-def command(name: Optional[str] = None) -> Callable[[Callable[..., CT]], Callable[..., CT]]:
-    """Decorator that registers the chosen command/function.
+    config_prod_help = 'Load the production configuration instead of development.'
+    run_parser = subparsers.add_parser('run', help='Run the application.')
+    run_parser.add_argument('-l', '--log_dir', metavar='DIR', help=(
+        'Log all statements to file in this directory instead of stdout. Only ERROR statements will go to stdout. stderr is not used.'
+    ))
+    run_parser.add_argument('--config_prod', action='store_true', help=config_prod_help)
 
-    If a function is decorated with @command but that function name is not a valid "command" according to the docstring,
-    a KeyError will be raised, since that's a bug in this script.
+    status_parser = subparsers.add_parser('status', help='Show status of router.')
+    status_parser.add_argument('--config_prod', action='store_true', help=config_prod_help)
 
-    If a user doesn't specify a valid command in their command line arguments, the above docopt(__doc__) line will print
-    a short summary and call sys.exit() and stop up there.
+    return parser
 
-    If a user specifies a valid command, but for some reason the developer did not register it, an AttributeError will
-    raise, since it is a bug in this script.
 
-    Finally, if a user specifies a valid command and it is registered with @command below, then that command is "chosen"
-    by this decorator function, and set as the attribute `chosen`. It is then executed below in
-    `if __name__ == '__main__':`.
+def print_table(table_rows: dict, header: Optional[str] = None) -> None:
+    max_len_key = max(map(len, table_rows))
+    max_len_val = max(map(len, table_rows.values()))
 
-    Doing this instead of using Flask-Script.
+    row_separator = '| ' + '-' * max_len_key + ' + ' + '-' * max_len_val + ' |'
+    border = '+' + '-' * (max_len_key + max_len_val + 5) + '+'
 
-    Positional arguments:
-    func -- the function to decorate
+    lines = [border]
+    if header:
+        lines.append('| ' + header.ljust(max_len_key + max_len_val + 3) + ' |')
+        lines.append(row_separator)
+
+    lines.append('| ' + 'Item'.ljust(max_len_key) + ' | ' + 'Value'.ljust(max_len_val) + ' |')
+    lines.append(row_separator)
+    lines.extend(['| ' + key.ljust(max_len_key) + ' | ' + value.ljust(max_len_val) + ' |' for key, value in table_rows.items()])
+    lines.append(border)
+
+    output = '\n'.join(lines) + '\n'
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is None:
+        sys.stdout.write(output)
+        return
+    # Whole table goes to the binary buffer as one write, text layer is flushed first to keep order of output
+    sys.stdout.flush()
+    buffer.write(output.encode(sys.stdout.encoding or 'UTF-8', sys.stdout.errors or 'strict'))
+    buffer.flush()
+
+
+class ConnectionProbe:
+    """Pings targets through a single long-lived raw ICMP socket.
+
+    Target names are resolved once, and at most every RESOLVE_INTERVAL seconds unanswered targets of a healthy check
+    are looked up again (their address might have moved), so DNS is kept out of the loop while the link is failing.
+    A check is an error when its own ping burst is over the threshold and so is the error rate over the window.
+    Window holds only the failing checks since the last healthy one (at most WINDOW_SIZE of them), so a target
+    that never answers does not pile up in it, and both an outage and a recovery are reported by their first check.
     """
+    WINDOW_SIZE = 10
+    TIMEOUT = 2.0  # seconds
+    RETRY = 1  # Watchdog loop checks again soon anyway
+    RESOLVE_INTERVAL = 60 * 60  # seconds
+
+    def __init__(self, targets: List[str]):
+        self.targets = targets
+        self.windows: Dict[str, Deque[Optional[float]]] = {target: deque(maxlen=self.WINDOW_SIZE) for target in targets}
+        self.rtts: Dict[str, Deque[float]] = {target: deque(maxlen=self.WINDOW_SIZE) for target in targets}
+        self._addresses: Dict[str, str] = {}
+        self._sock: Optional[socket.socket] = None
+        self._next_resolve = time.monotonic() + self.RESOLVE_INTERVAL
+        self.resolve()
+
+    def resolve(self) -> Dict[str, str]:
+        """Resolve target names not resolved yet to IPv4 addresses, pings then go to addresses directly."""
+        for target in self.targets:
+            if target not in self._addresses:
+                try:
+                    self._addresses[target] = socket.gethostbyname(target)
+                except OSError:
+                    pass  # Lookup is retried on next check, target counts as failed until then
+        return self._addresses
+
+    def _ping(self, pending: Dict[str, str], results: Dict[str, Optional[float]], threshold: int) -> None:
+        """Ping pending targets, recording round trip time of those that responded to results.
+
+        Results hold every target, None until it answers, so targets that failed to resolve count as failed too.
+        Unanswered targets are pinged again up to RETRY times, unless their outcome can no longer change the verdict.
+        """
+        from netkeeper.ext.multiping import MultiPing
+
+        if not self._sock:
+            self._sock = MultiPing._open_icmp_socket(socket.AF_INET)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)
+        mp = MultiPing(list(set(pending.values())), sock=self._sock)
+        for _ in range(self.RETRY + 1):
+            mp.send()
+            responses, _ = mp.receive(self.TIMEOUT / (self.RETRY + 1))
+            for target, address in list(pending.items()):
+                if address in responses:
+                    results[target] = responses[address]
+                    del pending[target]
+            if not pending:
+                return
+            all_ok = self.is_error({**results, **dict.fromkeys(pending, 0.0)}, threshold)
+            all_failed = self.is_error({**results, **dict.fromkeys(pending)}, threshold)
+            if all_ok == all_failed:
+                return
+
+    def check(self, threshold: int) -> bool:
+        """Ping all targets and tell if the connection is in error state.
+
+        Round trip time of every target is recorded, None when no response came back.
+        """
+        addresses = self.resolve()
+        pending = {target: addresses[target] for target in self.targets if target in addresses}
+        results: Dict[str, Optional[float]] = dict.fromkeys(self.targets)
+        if pending:
+            try:
+                self._ping(pending, results, threshold)
+            except OSError:
+                # Socket is probably broken (eg.: network went down), open a new one on next check
+                if self._sock:
+                    self._sock.close()
+                self._sock = None
+
+        error = self.is_error(results, threshold)
+        for target, rtt in results.items():
+            if rtt is not None:
+                self.rtts[target].append(rtt)
+        if error:
+            for target, window in self.windows.items():
+                window.append(results[target])
+        else:
+            # Link is fine, failures recorded so far no longer apply
+            for window in self.windows.values():
+                window.clear()
+            if time.monotonic() >= self._next_resolve:
+                self._next_resolve = time.monotonic() + self.RESOLVE_INTERVAL
+                for target, rtt in results.items():
+                    if rtt is None:
+                        self._addresses.pop(target, None)  # Address might be stale (eg.: CDN moved), resolve it again
+        return error
+
+    def is_error(self, results: Dict[str, Optional[float]], threshold: int) -> bool:
+        """Tell if check with given results is an error, both burst and window error rate (in %) over threshold."""
+        burst_rate = (list(results.values()).count(None) / len(results)) * 100 if results else 0.0
+        return burst_rate > threshold and self.error_rate(results) > threshold
+
+    def error_rate(self, results: Optional[Dict[str, Optional[float]]] = None) -> float:
+        """Error rate (in %) over the window, optionally as it would be with given results appended."""
+        failed = 0
+        total = 0
+        for target, window in self.windows.items():
+            samples = list(window)
+            if results and target in results:
+                samples = (samples + [results[target]])[-self.WINDOW_SIZE:]
+            failed += samples.count(None)
+            total += len(samples)
+        return (failed / total) * 100 if total else 0.0
+
+    def average_rtt(self) -> Optional[float]:
+        """Average round trip time (in seconds) of the last WINDOW_SIZE answered pings per target."""
+        rtts = [rtt for target_rtts in self.rtts.values() for rtt in target_rtts]
+        return sum(rtts) / len(rtts) if rtts else None
+
+    def reset(self) -> None:
+        """Forget recorded results, eg.: after modem restart, when old failures no longer apply."""
+        for window in self.windows.values():
+            window.clear()
+        for target_rtts in self.rtts.values():
+            target_rtts.clear()
+
+
+def is_connection_error(probe: ConnectionProbe, threshold: int) -> bool:
+    return probe.check(threshold)
+
+
+def healthy_check_interval(check_interval: int, average_rtt: Optional[float]) -> int:
+    """Shorten check interval while the connection is up but latency is climbing.
+
+    Interval is divided by (1 + average RTT / RTT_REFERENCE_MS), so it stays close to CHECK_INTERVAL on a fast link,
+    and a degrading link is watched more closely before it actually fails.
+    """
+    if not average_rtt:
+        return check_interval
+    interval = check_interval / (1 + (average_rtt * 1000) / RTT_REFERENCE_MS)
+    return int(min(check_interval, max(MIN_CHECK_INTERVAL, interval)))
 
-    def function_wrap(func: Callable[..., CT]) -> Callable[..., CT]:
-
-        @wraps(func)
-        def wrapped() -> CT:
-            return func()
-
-        command_name = name if name else func.__name__
 
-        # Register chosen function.
-        if command_name not in OPTIONS:
-            raise KeyError('Cannot register {}, not mentioned in docstring/docopt.'.format(command_name))
-        if OPTIONS[command_name]:
-            command.chosen = func  # type: ignore
+@lru_cache(maxsize=1)
+def modem_errors() -> Tuple[Type[Exception], ...]:
+    """Exceptions raised when modem is not reachable or refuses the request."""
+    from huawei_lte_api.exceptions import ResponseErrorException
+    from requests.exceptions import RequestException
 
-        return wrapped
+    return ResponseErrorException, RequestException
 
-    return function_wrap
 
+@lru_cache(maxsize=1)
+def connection_status_to_text() -> Mapping[ConnectionStatusEnum, str]:
+    from huawei_lte_api.enums.cradle import ConnectionStatusEnum
 
-def print_table(table_rows: dict, header: Optional[str] = None) -> None:
-    max_len_key = max(len(i) for i in list(table_rows.keys()))
-    max_len_val = max(len(i) for i in list(table_rows.values()))
+    return MappingProxyType({
+        ConnectionStatusEnum.CONNECTED: 'Connected',
+        ConnectionStatusEnum.CONNECTING: 'Connecting',
+        ConnectionStatusEnum.DISCONNECTED: 'Disconnected',
+        ConnectionStatusEnum.DISCONNECTING: 'Disconnecting',
+        ConnectionStatusEnum.CONNECT_FAILED: 'Connect FAILED',
+        ConnectionStatusEnum.CONNECT_STATUS_ERROR: 'Connect ERROR',
+        ConnectionStatusEnum.CONNECT_STATUS_NULL: 'Connect NULL',
+    })
 
-    header_format = '| {{:{}s}} |'.format(max_len_key + max_len_val + 3)
-    row_format = '| {{:{}s}} | {{:{}s}} |'.format(max_len_key, max_len_val)
-    row_format_separator = '| {{:{}s}} + {{:{}s}} |'.format(max_len_key, max_len_val)
 
-    print('+{}+'.format('-' * (max_len_key + max_len_val + 5)))
+class ModemSession:
+    """Keeps authorized modem connection alive between watchdog iterations.
 
-    if header:
-        print(header_format.format(header))
-        print(row_format_separator.format('-' * max_len_key, '-' * max_len_val))
+    Connection is opened on first use and opened again when a request fails on it, or when it was
+    not used successfully for MAX_IDLE seconds, so the login round trips are not repeated on every check.
+    """
+    MAX_IDLE = 30 * 60
+
+    def __init__(self, url: str, timeout: float):
+        self.url = url
+        self.timeout = timeout
+        self.last_ok_at: Optional[float] = None
+        self._connection: Optional[AuthorizedConnection] = None
+        self._client: Optional[Client] = None
+
+    def _reconnect(self) -> Client:
+        from huawei_lte_api.AuthorizedConnection import AuthorizedConnection
+        from huawei_lte_api.Client import Client
+
+        self.close()
+        self._connection = AuthorizedConnection(self.url, timeout=self.timeout)
+        self._client = Client(self._connection)
+        return self._client
+
+    def close(self) -> None:
+        """Log out from modem when session is still usable, close the HTTP session and forget it."""
+        connection = self._connection
+        self._connection = None
+        self._client = None
+        if connection:
+            if self.last_ok_at is not None:
+                try:
+                    connection.close()  # Closes HTTP session as well, even when logout fails
+                except modem_errors():
+                    pass
+            else:
+                connection.requests_session.close()  # Logout would only wait for a modem that is not there
+        self.last_ok_at = None
 
-    print(row_format.format('Item', 'Value'))
-    print(row_format_separator.format('-' * max_len_key, '-' * max_len_val))
-    for key in table_rows:
-        print(row_format.format(key, table_rows[key]))
+    def monitoring_status(self) -> dict:
+        client = self._client
+        fresh = False
+        if not client or self.last_ok_at is None or time.monotonic() - self.last_ok_at > self.MAX_IDLE:
+            client = self._reconnect()
+            fresh = True
 
-    print('+{}+'.format('-' * (max_len_key + max_len_val + 5)))
+        try:
+            monitoring = client.monitoring.status()
+        except modem_errors():
+            if fresh:
+                raise
+            # Session might have expired on modem side, try once more with a new one
+            monitoring = self._reconnect().monitoring.status()
 
+        self.last_ok_at = time.monotonic()
+        return monitoring
 
-def is_connection_error(targets: List[str], threshold: int) -> bool:
-    try:
-        _, no_responses = multi_ping(targets, timeout=2, retry=3)
-        error_rate = (len(no_responses) / len(targets)) * 100
-        return error_rate > threshold
-    except MultiPingSocketError:
-        return True
+    def reboot(self) -> None:
+        client = self._client or self._reconnect()
+        client.device.reboot()
+        self.last_ok_at = None  # Session is gone with the reboot
 
 
-def restart_modem_and_wait_for_alive(connection: AuthorizedConnection, log: logging.Logger) -> None:
-    client = Client(connection)
+def restart_modem_and_wait_for_alive(session: ModemSession, log: logging.Logger) -> None:
     log.warning('Restarting modem!')
-    client.device.reboot()
+    session.reboot()
     log.warning('Waiting for modem to restart')
-    time.sleep(20)
+    if STOP_EVENT.wait(10):
+        return
     log.warning('Waiting for modem to become live')
-    while True:
+    # Modem is usually back in tens of seconds, so start polling often and back off up to 30s between attempts
+    for delay in itertools.chain([2, 4, 8, 16], itertools.repeat(30)):
         try:
-            connection.reload()
-            client.monitoring.status()
+            session.monitoring_status()
             log.warning('Modem booted')
             return
-        except ResponseErrorException as e:
-            log.warning('Modem not available', exc_info=e)
-            time.sleep(20)
+        except modem_errors() as e:
+            log.warning('Modem not available, next attempt in %ss', delay, exc_info=e)
+            if STOP_EVENT.wait(delay):
+                return
 
 
-def call_systemd(service_name: str, argument: str) -> bool:
+@lru_cache(maxsize=1)
+def _systemctl_path() -> str:
     found_systemctl = shutil.which('systemctl')
     if not found_systemctl:
         raise ValueError('systemctl binary was not found')
+    return found_systemctl
 
-    with subprocess.Popen([found_systemctl, argument, '--quiet', service_name]) as p:  # nosec B603
+
+def call_systemd(service_name: str, argument: str) -> bool:
+    with subprocess.Popen([_systemctl_path(), argument, '--quiet', service_name]) as p:  # nosec B603
         p.wait()
         return p.returncode == 0
 
 
-def is_service_active(service_name: str) -> bool:
-    return call_systemd(service_name, 'is-enabled')
+def query_services(service_names: List[str], log: logging.Logger) -> Dict[str, Tuple[str, str]]:
+    """Return (ActiveState, UnitFileState) of every service, queried by a single systemctl call.
 
-
-def is_service_enabled(service_name: str) -> bool:
-    return call_systemd(service_name, 'is-enabled')
+    Output of systemctl is matched to services by unit names, with or without the .service suffix.
+    Services systemctl printed nothing about are left out, the rest keeps order of service_names.
+    """
+    if not service_names:
+        return {}
+    result = subprocess.run(  # nosec B603
+        [_systemctl_path(), 'show', '--property=Id,Names,ActiveState,UnitFileState', '--'] + service_names,
+        capture_output=True, text=True, check=False
+    )
+    if result.returncode != 0:
+        log.warning('systemctl show failed (%s): %s', result.returncode, result.stderr.strip())
+
+    services_by_unit: Dict[str, str] = {}
+    for service_name in service_names:
+        services_by_unit.setdefault('{}.service'.format(service_name), service_name)
+        services_by_unit[service_name] = service_name
+    # systemctl prints one block of properties per unit, separated by empty line
+    states = {}
+    for block in result.stdout.strip().split('\n\n'):
+        properties = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        for unit in [properties.get('Id', '')] + properties.get('Names', '').split():
+            if unit in services_by_unit:
+                states[services_by_unit[unit]] = (properties.get('ActiveState', ''), properties.get('UnitFileState', ''))
+                break
+    return {service_name: states[service_name] for service_name in service_names if service_name in states}
+
+
+def is_service_active_or_enabled(state: Tuple[str, str]) -> bool:
+    """Tell if service state returned by query_services is what systemctl is-active or is-enabled would succeed with."""
+    active_state, unit_file_state = state
+    return active_state in SERVICE_ACTIVE_STATES or unit_file_state in SERVICE_ENABLED_STATES
 
 
 def restart_service(service_name: str) -> bool:
     return call_systemd(service_name, 'restart')
 
 
-@command()
-def run() -> None:  # pylint: disable=too-many-nested-blocks, too-many-statements, too-many-branches
-    options = parse_options()
-    setup_logging('run', logging.DEBUG if options.DEBUG else logging.WARNING)
+def run(args: argparse.Namespace) -> None:  # pylint: disable=too-many-nested-blocks, too-many-statements, too-many-branches, too-many-locals
+    from huawei_lte_api.enums.cradle import ConnectionStatusEnum
+
+    options = parse_options(args)
+    setup_logging('run', logging.DEBUG if options.DEBUG else logging.WARNING, args.log_dir)
     log = logging.getLogger(__name__)
     connected_counter = 0
     connecting_counter = 0
     restart_counter = 0
     max_restarts = 5
     after_reboot = False
+    probe = ConnectionProbe(options.TARGETS)
+    session = ModemSession(options.MODEM_URL, options.MODEM_TIMEOUT)
 
     while True:  # pylint: disable=too-many-nested-blocks
-        if is_connection_error(options.TARGETS, options.TARGETS_FAIL_THRESHOLD):
+        if is_connection_error(probe, options.TARGETS_FAIL_THRESHOLD):
             log.warning('Connection error rate reached threshold')
             # Connection seems to be in error state, check router connection
             try:
-                connection = AuthorizedConnection(options.MODEM_URL)  # Connect to modem
-                client = Client(connection)
-                monitoring = client.monitoring.status()
+                monitoring = session.monitoring_status()
 
                 # We was able to connect to modem
                 connection_status = int(monitoring['ConnectionStatus'])
-                lte_signal = int(monitoring['SignalIcon'])
                 if connection_status == ConnectionStatusEnum.CONNECTED:
                     if connected_counter == 0:
                         log.warning('Modem thinks its connected, sleeping for 1 minute...')
@@ -296,11 +646,13 @@ def run() -> None:  # pylint: disable=too-many-nested-blocks, too-many-statement
                         connected_counter += 1
                     else:
                         log.warning('Modem thinks its connected, and it is not a first time... check signal')
+                        lte_signal = int(monitoring['SignalIcon'] if 'SignalIcon' in monitoring else monitoring['SignalIconNr'])
                         if lte_signal < 2:
                             log.warning('BAD signal (%s) detected, restart', lte_signal)
                             connected_counter = 0
                             if restart_counter < max_restarts:
-                                restart_modem_and_wait_for_alive(connection, log)
+                                restart_modem_and_wait_for_alive(session, log)
+                                probe.reset()
                                 restart_counter += 1
                                 after_reboot = True
                                 sleep_time = 1
@@ -319,7 +671,8 @@ def run() -> None:  # pylint: disable=too-many-nested-blocks, too-many-statement
                         log.warning('Modem is in connecting state second time, restart')
                         connecting_counter = 0
                         if restart_counter < max_restarts:
-                            restart_modem_and_wait_for_alive(connection, log)
+                            restart_modem_and_wait_for_alive(session, log)
+                            probe.reset()
                             restart_counter += 1
                             after_reboot = True
                             sleep_time = 1
@@ -330,7 +683,8 @@ def run() -> None:  # pylint: disable=too-many-nested-blocks, too-many-statement
                 else:
                     log.warning('Modem is in connection state: %s, restarting...', connection_status)
                     if restart_counter < max_restarts:
-                        restart_modem_and_wait_for_alive(connection, log)
+                        restart_modem_and_wait_for_alive(session, log)
+                        probe.reset()
                         restart_counter += 1
                         after_reboot = True
                         sleep_time = 1
@@ -338,36 +692,46 @@ def run() -> None:  # pylint: disable=too-many-nested-blocks, too-many-statement
                         sleep_time = 60 * 60
                         restart_counter = 0
 
-            except ResponseErrorException as e:
+            except modem_errors() as e:
                 log.warning('Connection to modem failed, sleeping 10 minutes...', exc_info=e)
                 sleep_time = 60 * 10
         else:
             connected_counter = 0
             connecting_counter = 0
             restart_counter = 0
-            sleep_time = options.CHECK_INTERVAL
+            sleep_time = healthy_check_interval(options.CHECK_INTERVAL, probe.average_rtt())
             log.info('All is OK, sleeping for %ss', sleep_time)
             if after_reboot:
                 after_reboot = False
                 # Restart services when enabled or active
-                for service in options.RESTART_SERVICES:
-                    if is_service_active(service) or is_service_enabled(service):
+                for service, service_state in query_services(options.RESTART_SERVICES, log).items():
+                    if is_service_active_or_enabled(service_state):
                         log.warning('Restarting service %s', service)
                         restart_service(service)
-        time.sleep(sleep_time)
+        if STOP_EVENT.wait(sleep_time):
+            return
+
 
+def status(args: argparse.Namespace) -> None:  # pylint: disable=too-many-locals
+    from huawei_lte_api.AuthorizedConnection import AuthorizedConnection
+    from huawei_lte_api.Client import Client
+    from huawei_lte_api.enums.cradle import ConnectionStatusEnum
+    from netkeeper.ext.multiping import multi_ping, MultiPingSocketError
 
-@command()
-def status() -> None:
-    options = parse_options()
+    options = parse_options(args)
 
-    connection = AuthorizedConnection(options.MODEM_URL)
-    client = Client(connection)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # Ping targets while talking to modem, both spend most of the time waiting on network
+        pinging = pool.submit(multi_ping, options.TARGETS, timeout=2, retry=3)
+        connection = AuthorizedConnection(options.MODEM_URL, timeout=options.MODEM_TIMEOUT)
+        client = Client(connection)
+        information = client.device.information()
+        monitoring = client.monitoring.status()
 
     table_rows = {}
 
     try:
-        responses, no_responses = multi_ping(options.TARGETS, timeout=2, retry=3)
+        responses, no_responses = pinging.result()
     except MultiPingSocketError as e:
         responses = {}
         no_responses = []
@@ -381,19 +745,6 @@ def status() -> None:
 
     print_table(table_rows, 'Ping Info')
 
-    information = client.device.information()
-    monitoring = client.monitoring.status()
-
-    connection_status_to_text = {
-        ConnectionStatusEnum.CONNECTED: 'Connected',
-        ConnectionStatusEnum.CONNECTING: 'Connecting',
-        ConnectionStatusEnum.DISCONNECTED: 'Disconnected',
-        ConnectionStatusEnum.DISCONNECTING: 'Disconnecting',
-        ConnectionStatusEnum.CONNECT_FAILED: 'Connect FAILED',
-        ConnectionStatusEnum.CONNECT_STATUS_ERROR: 'Connect ERROR',
-        ConnectionStatusEnum.CONNECT_STATUS_NULL: 'Connect NULL',
-    }
-
     table_rows = {
         'Device name': information.get('DeviceName', '???'),
         'Device serial number': information.get('SerialNumber', '???'),
@@ -401,7 +752,7 @@ def status() -> None:
         'Device version': information.get('HardwareVersion', '???'),
         'Device MAC': information.get('MacAddress1', '???'),
         'Work mode': information.get('workmode', '???'),
-        'Internet connection status': connection_status_to_text.get(ConnectionStatusEnum(int(monitoring.get('ConnectionStatus', 906))), 'Unknown'),
+        'Internet connection status': connection_status_to_text().get(ConnectionStatusEnum(int(monitoring.get('ConnectionStatus', 906))), 'Unknown'),
         'Signal': '{}/{}'.format(monitoring.get('SignalIcon', monitoring.get('SignalIconNr')), monitoring.get('maxsignal')),
         'WAN IP': monitoring.get('WanIPAddress', information.get('WanIPAddress', '???')),
         'Primary DNS': monitoring.get('PrimaryDns', '???'),
@@ -411,9 +762,21 @@ def status() -> None:
     print_table(table_rows, 'Modem Info')
 
 
-def main() -> None:
-    signal.signal(signal.SIGINT, lambda *_: sys.exit(0))  # Properly handle Control+C
-    getattr(command, 'chosen')()  # Execute the function specified by the user.
+def stop(*_: Any) -> None:
+    """Signal handler, wakes up everything waiting on STOP_EVENT and exits."""
+    STOP_EVENT.set()
+    sys.exit(0)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+    signal.signal(signal.SIGINT, stop)  # Properly handle Control+C
+    signal.signal(signal.SIGTERM, stop)  # Exit through atexit so buffered logs get written
+    # Execute the function specified by the user.
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'status':
+        status(args)
 
 
 if __name__ == '__main__':
@@ -79,6 +79,7 @@ class MultiPing:
     _time_stamp_size: int
     _receive_has_been_called: bool
     _ipv6_address_present: bool
+    _owns_sock: bool
 
 
     def __init__(self, dest_addrs: List[str], sock: Optional[socket.socket] = None, ignore_lookup_errors: bool = False):
@@ -121,7 +122,9 @@ class MultiPing:
         # process echo
         self.ident = os.getpid() & 0xffff
 
-        # Open an ICMP socket, if we weren't provided with one already
+        # Open an ICMP socket, if we weren't provided with one already. A
+        # provided socket belongs to the caller and is not closed by us.
+        self._owns_sock = not sock
         if sock:
             self._sock = sock
             self._sock6 = None
@@ -393,7 +396,7 @@ class MultiPing:
 
         return pkts
 
-    def receive(self, timeout: float) -> Tuple[Dict[str, int], List[str]]:
+    def receive(self, timeout: float) -> Tuple[Dict[str, float], List[str]]:
         """
         Receive ping responses from the socket. Attempts to read responses for
         all stored IDs (as generated by send()).
@@ -485,14 +488,15 @@ class MultiPing:
             Close sockets descriptors.
         """
 
-        if self._sock:
+        if self._sock and self._owns_sock:
             self._sock.close()
 
         if self._sock6:
             self._sock6.close()
 
 
-def multi_ping(dest_addrs: List[str], timeout: Union[int, float], retry: int = 0, ignore_lookup_errors: bool = False) -> Tuple[Dict[str, int], List[str]]:
+def multi_ping(dest_addrs: List[str], timeout: Union[int, float], retry: int = 0, ignore_lookup_errors: bool = False,
+               sock: Optional[socket.socket] = None) -> Tuple[Dict[str, float], List[str]]:
     """
     Combine send and receive measurement into single function.
 
@@ -510,6 +514,10 @@ def multi_ping(dest_addrs: List[str], timeout: Union[int, float], retry: int = 0
     names or looking up their address information will silently be ignored.
     Those targets simply appear in the 'no_results' return list.
 
+    If 'sock' is provided, it is used for sending and receiving instead of
+    opening new ICMP sockets, which allows reusing a single socket across
+    calls. Only IPv4 targets can be pinged through it.
+
     """
     retry = max(int(retry), 0)
     if isinstance(timeout, int):
@@ -521,7 +529,7 @@ def multi_ping(dest_addrs: List[str], timeout: Union[int, float], retry: int = 0
     if retry_timeout < 0.1:
         raise MultiPingError("Time between ping retries < 0.1 seconds")
 
-    mp = MultiPing(dest_addrs, ignore_lookup_errors=ignore_lookup_errors)
+    mp = MultiPing(dest_addrs, sock=sock, ignore_lookup_errors=ignore_lookup_errors)
 
     results = {}
     retry_count = 0
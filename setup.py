@@ -41,8 +41,7 @@ setup(
     classifiers=classifiers,
     packages=find_packages(exclude=['tests', 'tests.*']),
     install_requires=[
-        'pyyaml',
-        'docopt',
+        'pyyaml',  # Uses the faster libyaml based loader when PyYAML was built with libyaml (libyaml-dev installed)
         'huawei-lte-api'
     ],
     test_suite="tests",
@@ -0,0 +1,242 @@
+import logging
+import os
+import socket
+import subprocess  # nosec B404
+from typing import Any, Callable, Dict, Iterator, List
+import pytest
+from netkeeper.bin import netkeeper
+from netkeeper.ext import multiping
+from netkeeper.bin.netkeeper import _load_yaml, ModemSession, build_parser, print_table, query_services, is_service_active_or_enabled, ConnectionProbe, \
+    BufferedTimedRotatingFileHandler
+
+TARGETS = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+lookups: List[str] = []
+
+
+class FakeMultiPing:
+    """Stands in for MultiPing, answering every burst with next item of RESPONSES."""
+    RESPONSES: Iterator[Dict[str, float]] = iter([])
+    sent = 0
+
+    def __init__(self, dest_addrs: List[str], sock: Any = None):
+        self.dest_addrs = dest_addrs
+
+    def send(self) -> None:
+        FakeMultiPing.sent += 1
+
+    def receive(self, _timeout: float) -> Any:
+        responses = next(self.RESPONSES)
+        return responses, [address for address in self.dest_addrs if address not in responses]
+
+
+@pytest.fixture
+def probe_factory(monkeypatch: pytest.MonkeyPatch) -> Iterator[Callable[[List[str]], ConnectionProbe]]:
+    def resolve(target: str) -> str:
+        lookups.append(target)
+        if target.endswith('.invalid'):
+            raise socket.gaierror(target)
+        return target
+
+    sockets = []
+
+    def make_probe(targets: List[str]) -> ConnectionProbe:
+        connection_probe = ConnectionProbe(targets)
+        sockets.append(socket.socket())
+        connection_probe._sock = sockets[-1]  # Never used by FakeMultiPing
+        return connection_probe
+
+    monkeypatch.setattr(multiping, 'MultiPing', FakeMultiPing)
+    monkeypatch.setattr(socket, 'gethostbyname', resolve)
+    FakeMultiPing.sent = 0
+    lookups.clear()
+    yield make_probe
+    for sock in sockets:
+        sock.close()
+
+
+@pytest.fixture
+def probe(probe_factory: Callable[[List[str]], ConnectionProbe]) -> ConnectionProbe:
+    return probe_factory(TARGETS)
+
+
+def answered(*addresses: str) -> Dict[str, float]:
+    return dict.fromkeys(addresses, 0.01)
+
+
+def test_parse_run() -> None:
+    args = build_parser().parse_args(['run', '-l', '/var/log', '--config_prod'])
+    assert args.command == 'run'
+    assert args.log_dir == '/var/log'
+    assert args.config_prod
+
+
+def test_parse_status() -> None:
+    args = build_parser().parse_args(['status'])
+    assert args.command == 'status'
+    assert not args.config_prod
+
+
+def test_parse_missing_command() -> None:
+    with pytest.raises(SystemExit):
+        build_parser().parse_args([])
+
+
+def test_print_table(capsys: pytest.CaptureFixture) -> None:
+    print_table({'8.8.8.8': 'ONLINE: 0.0100s', 'google.com': '!!!OFF-LINE!!!'}, 'Ping Info')
+    assert capsys.readouterr().out == (
+        '+------------------------------+\n'
+        '| Ping Info                    |\n'
+        '| ---------- + --------------- |\n'
+        '| Item       | Value           |\n'
+        '| ---------- + --------------- |\n'
+        '| 8.8.8.8    | ONLINE: 0.0100s |\n'
+        '| google.com | !!!OFF-LINE!!!  |\n'
+        '+------------------------------+\n'
+    )
+
+
+def test_query_services(monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture) -> None:
+    def fake_run(args: Any, **_: Any) -> subprocess.CompletedProcess:
+        assert args[1:] == [
+            'show', '--property=Id,Names,ActiveState,UnitFileState', '--', 'openvpn@client', 'sshd', 'nginx.service', 'missing'
+        ]
+        # Blocks out of order, sshd is an alias, nothing printed about missing
+        stdout = (
+            'Id=nginx.service\nNames=nginx.service\nActiveState=inactive\nUnitFileState=\n\n'
+            'Id=openvpn@client.service\nNames=openvpn@client.service\nActiveState=active\nUnitFileState=disabled\n\n'
+            'Id=ssh.service\nNames=ssh.service sshd.service\nActiveState=inactive\nUnitFileState=enabled\n'
+        )
+        return subprocess.CompletedProcess(args, 1, stdout, 'Failed to get properties: Unit name missing is not valid.\n')
+
+    monkeypatch.setattr(netkeeper, '_systemctl_path', lambda: '/usr/bin/systemctl')
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    states = query_services(['openvpn@client', 'sshd', 'nginx.service', 'missing'], logging.getLogger(__name__))
+    assert states == {
+        'openvpn@client': ('active', 'disabled'),
+        'sshd': ('inactive', 'enabled'),
+        'nginx.service': ('inactive', ''),
+    }
+    assert [is_service_active_or_enabled(state) for state in states.values()] == [True, True, False]
+    assert 'Unit name missing is not valid' in caplog.text
+
+
+def test_probe_reports_outage_and_recovery_right_away(probe: ConnectionProbe) -> None:
+    FakeMultiPing.RESPONSES = iter([answered(*TARGETS)] * 5 + [{}, {}] + [answered(*TARGETS)])
+    assert not any(probe.check(50) for _ in range(5))
+    assert probe.check(50)  # Outage, reported by its first check
+    assert FakeMultiPing.sent == 5 + 2
+    assert not probe.check(50)  # Recovered, reported by its first check as well
+    assert probe.error_rate() == 0.0
+    assert probe.average_rtt() == pytest.approx(0.01)
+
+
+def test_probe_with_dead_target_reports_outage_right_away(probe: ConnectionProbe) -> None:
+    # 10.0.0.3 never answers (eg.: drops ICMP)
+    FakeMultiPing.RESPONSES = iter([answered('10.0.0.1', '10.0.0.2')] * 12 + [{}, {}] + [answered('10.0.0.1', '10.0.0.2')])
+    assert not any(probe.check(50) for _ in range(12))
+    assert probe.check(50)
+    assert not probe.check(50)
+
+
+def test_probe_retries_while_verdict_can_change(probe: ConnectionProbe) -> None:
+    FakeMultiPing.RESPONSES = iter([answered('10.0.0.1'), answered('10.0.0.2', '10.0.0.3')])
+    assert not probe.check(50)
+    assert FakeMultiPing.sent == 2
+
+
+def test_probe_stops_once_verdict_cannot_change(probe: ConnectionProbe) -> None:
+    FakeMultiPing.RESPONSES = iter([answered('10.0.0.1', '10.0.0.3')])
+    assert not probe.check(50)  # One of three failed, error rate stays under 50% whatever retry would bring
+    assert FakeMultiPing.sent == 1
+
+
+def test_probe_counts_unresolved_targets_as_failed(probe_factory: Callable[[List[str]], ConnectionProbe]) -> None:
+    probe = probe_factory(['10.0.0.1', '10.0.0.2', 'modem.invalid'])
+    FakeMultiPing.RESPONSES = iter([answered('10.0.0.1'), answered('10.0.0.2')])
+    # 10.0.0.2 answering on retry decides the verdict, unresolved target alone is just under threshold
+    assert not probe.check(50)
+    assert FakeMultiPing.sent == 2
+    assert probe.error_rate() == 0.0  # Healthy check clears the window
+
+    FakeMultiPing.RESPONSES = iter([answered('10.0.0.1')])
+    assert probe.check(20)  # Unresolved target already puts the check over threshold, retry is skipped
+    assert FakeMultiPing.sent == 3
+
+
+def test_error_rate_with_results(probe: ConnectionProbe) -> None:
+    assert probe.error_rate() == 0.0
+    probe.windows['10.0.0.1'].extend([None] * ConnectionProbe.WINDOW_SIZE)
+    probe.windows['10.0.0.2'].extend([0.01] * ConnectionProbe.WINDOW_SIZE)
+    assert probe.error_rate() == 50.0
+    # Appended results push the oldest samples out of the window
+    assert probe.error_rate({'10.0.0.1': 0.01, '10.0.0.2': None, '10.0.0.3': None}) == pytest.approx(11 / 21 * 100)
+
+
+def test_probe_resolves_again_only_unanswered_targets(probe: ConnectionProbe) -> None:
+    assert lookups == TARGETS
+    FakeMultiPing.RESPONSES = iter([answered('10.0.0.1', '10.0.0.2')] * 2 + [{}, {}] + [answered('10.0.0.1', '10.0.0.2')] * 3)
+    probe.check(50)
+    probe.check(50)
+    assert lookups == TARGETS  # Not before RESOLVE_INTERVAL passed
+    probe._next_resolve = 0.0
+    assert probe.check(50)
+    probe.check(50)
+    assert lookups == TARGETS  # Not on a failing check, address is dropped by the healthy one after it
+    probe.check(50)
+    probe.check(50)
+    assert lookups == TARGETS + ['10.0.0.3']
+
+
+def test_log_warnings_are_written_right_away(tmp_path: Any) -> None:
+    log_file = tmp_path / 'netkeeper.log'
+    handler = BufferedTimedRotatingFileHandler(str(log_file), when='d')
+    try:
+        for message in ['first', 'Restarting modem!', 'Restarting service postfix']:
+            handler.handle(logging.makeLogRecord({'levelno': logging.WARNING, 'msg': message}))
+        handler.handle(logging.makeLogRecord({'levelno': logging.DEBUG, 'msg': 'buffered'}))
+        assert log_file.read_text(encoding='UTF-8') == 'first\nRestarting modem!\nRestarting service postfix\n'
+    finally:
+        handler.close()
+    assert log_file.read_text(encoding='UTF-8').endswith('buffered\n')
+
+
+@pytest.mark.parametrize('content, data, cached', [
+    ('MODEM_URL: http://192.168.8.1/\nTARGETS: [google.com]\n', {'MODEM_URL': 'http://192.168.8.1/', 'TARGETS': ['google.com']}, True),
+    ('MAPPING: {1: one}\n', {'MAPPING': {1: 'one'}}, False),
+])
+def test_load_yaml_cache(monkeypatch: pytest.MonkeyPatch, tmp_path: Any, content: str, data: dict, cached: bool) -> None:
+    monkeypatch.setattr(netkeeper, 'CACHE_FOLDER', str(tmp_path / 'cache'))
+    config_file = tmp_path / 'config.yml'
+    config_file.write_text(content, encoding='UTF-8')
+    stat = os.stat(config_file)
+    for _ in range(2):
+        _load_yaml.cache_clear()
+        assert _load_yaml(str(config_file), stat.st_mtime_ns, stat.st_size) == data
+    assert os.path.exists('{}.cache.json'.format(config_file)) == cached
+
+
+def test_modem_session_close_releases_http_session() -> None:
+    class FakeRequestsSession:
+        closed = False
+
+        def close(self) -> None:
+            self.closed = True
+
+    class FakeConnection:
+        logged_out = False
+
+        def __init__(self) -> None:
+            self.requests_session = FakeRequestsSession()
+
+        def close(self) -> None:
+            self.logged_out = True
+            self.requests_session.close()
+
+    session = ModemSession('http://192.168.8.1/', 5)
+    for last_ok_at, logged_out in [(1.0, True), (None, False)]:  # Usable session, session gone with reboot
+        connection: Any = FakeConnection()
+        session._connection = connection
+        session.last_ok_at = last_ok_at
+        session.close()
+        assert connection.requests_session.closed
+        assert connection.logged_out == logged_out